@@ -26,32 +26,234 @@ This file contains all of the matrix/tensor contraction routines used to compute
 
 """
 
-import os
 from psutil import cpu_count
-# Set up threading options for parallel solver
-os.environ['OMP_NUM_THREADS']= str(int(cpu_count(logical=False))) # Set number of OpenMP threads
-os.environ['MKL_NUM_THREADS']= str(int(cpu_count(logical=False))) # Set number of MKL threads
-os.environ['NUMBA_NUM_THREADS'] = str(int(cpu_count(logical=False))) # Set number of Numba threads
 import numpy as np
+from functools import lru_cache, wraps
+from opt_einsum import contract_expression
+from scipy.linalg.blas import get_blas_funcs
+from threadpoolctl import ThreadpoolController
 from .contract_vec import *
 from .contract_jit import *
 from .contract_cython import *
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+# Number of BLAS threads used by the methods which call BLAS (see _limit_blas): the physical core count,
+# or the value set when this module is imported (e.g. OMP_NUM_THREADS=1 in a script), if that is lower.
+# Setting OMP_NUM_THREADS or MKL_NUM_THREADS here would have no effect, as NumPy has already loaded BLAS.
+_threadpool = ThreadpoolController()
+_blas_threads = min([lib['num_threads'] for lib in _threadpool.select(user_api='blas').info()]+[int(cpu_count(logical=False))])
+_blas_methods = ['einsum','tensordot','blas']
+
+def _limit_blas(default):
+    """ Decorator which limits the BLAS thread pool to _blas_threads while a contraction runs.
+
+        The limit only applies to the methods which call BLAS, and is restored when the function returns,
+        so nothing else in the process is affected. Loop-based methods are called without any overhead.
+        The argument is the default value of 'method' for the decorated function.
+
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(A,B,method=default,*args,**kwargs):
+            if method in _blas_methods:
+                with _threadpool.limit(limits=_blas_threads,user_api='blas'):
+                    return func(A,B,method,*args,**kwargs)
+            return func(A,B,method,*args,**kwargs)
+        return wrapper
+    return decorator
+
+#------------------------------------------------------------------------------
+# Cached contraction paths
+
+@lru_cache(maxsize=64)
+def _con42_exprs(m):
+    """ Builds the four opt_einsum expressions used by con42 for a given system size.
+
+        The optimal contraction path is found once per value of m and re-used on every subsequent
+        call, rather than being re-computed each time the RHS of the flow equations is evaluated.
+        Each expression returns its result with indices already in the order (i,j,k,q).
+
+    """
+    shape4 = (m,m,m,m)
+    shape2 = (m,m)
+    return (contract_expression('ijkl,lq->ijkq',shape4,shape2,optimize='optimal'),
+            contract_expression('ijlq,kl->ijkq',shape4,shape2,optimize='optimal'),
+            contract_expression('ilkq,lj->ijkq',shape4,shape2,optimize='optimal'),
+            contract_expression('ljkq,il->ijkq',shape4,shape2,optimize='optimal'))
+
+@lru_cache(maxsize=64)
+def _con42_NO_exprs(m):
+    """ Builds the four opt_einsum expressions used by _con42_NO_einsum for a given system size. """
+    shape4 = (m,m,m,m)
+    shape2 = (m,m)
+    return (contract_expression('ijkq,kq->ij',shape4,shape2,optimize='optimal'),
+            contract_expression('kqij,kq->ij',shape4,shape2,optimize='optimal'),
+            contract_expression('kjiq,kq->ij',shape4,shape2,optimize='optimal'),
+            contract_expression('iqkj,kq->ij',shape4,shape2,optimize='optimal'))
+
+@lru_cache(maxsize=64)
+def _con44_NO_exprs(m):
+    """ Builds the six opt_einsum expressions used by _con44_NO_einsum for a given system size.
+
+        Each expression contracts A with an occupation-weight matrix and a combination of B over the 
+        indices (l,m). The optimal path (weight into A, then a single GEMM) is found once per value 
+        of m. The expressions are backend-agnostic, so they can be called with NumPy or CuPy arrays.
+
+    """
+    shape4 = (m,m,m,m)
+    shape2 = (m,m)
+    return (contract_expression('ijlm,lm,mlkq->ijkq',shape4,shape2,shape4,optimize='optimal'),
+            contract_expression('lmij,lm,mlkq->ijkq',shape4,shape2,shape4,optimize='optimal'),
+            contract_expression('ljim,lm,mlkq->ijkq',shape4,shape2,shape4,optimize='optimal'),
+            contract_expression('ilmj,lm,lmkq->ijkq',shape4,shape2,shape4,optimize='optimal'),
+            contract_expression('ljmq,lm,imkl->ijkq',shape4,shape2,shape4,optimize='optimal'),
+            contract_expression('ilkm,lm,mjlq->ijkq',shape4,shape2,shape4,optimize='optimal'))
+
+@lru_cache(maxsize=64)
+def _batch_expr(shape):
+    """ Cached opt_einsum expression for a stack of matrix products, used by contract_batch. """
+    return contract_expression('bij,bjk->bik',shape,shape,optimize='optimal')
+
+def _con22_blas(A,B,out=None):
+    """ Computes the commutator A@B - B@A with two calls to BLAS gemm.
+
+        The second call accumulates directly into the output of the first (beta=1), so no temporary
+        matrices are allocated for the two products or their difference. BLAS works in Fortran order, 
+        so the transposed problem B.T@A.T - A.T@B.T is computed on the transposes of the (C-ordered) 
+        inputs, which are Fortran-ordered views, and the result is transposed back. If out is given 
+        (a C-contiguous array of the right dtype), BLAS writes into it directly.
+
+    """
+    gemm = get_blas_funcs('gemm',(A,B))
+    if out is None:
+        C = gemm(1.0,B.T,A.T)
+    else:
+        C = gemm(1.0,B.T,A.T,beta=0.0,c=out.T,overwrite_c=True)
+    C = gemm(-1.0,A.T,B.T,beta=1.0,c=C,overwrite_c=True)
+    if out is not None and np.shares_memory(C,out):
+        # BLAS wrote into out itself (it copies c if out has the wrong layout or dtype)
+        return out
+    return C.T
+
+def _con42_blas(A,B,pair=None,out=None):
+    """ Computes con42 as matrix multiplications on reshaped views of A.
+
+        Each of the four terms contracts B with a different index of A. By viewing A as a matrix
+        (or a stack of matrices) with the contracted index in the right place, every term becomes a
+        single GEMM call (or a batch of them) whose output is already in the order (i,j,k,q), so no 
+        axes need to be moved and no rank-4 intermediates need to be transposed.
+
+        If pair='first' or pair='second', only the two terms acting on that pair of indices are computed.
+        The first term is written straight into out, if given and C-contiguous; otherwise the result is
+        computed in a new array, which the caller copies into out (see _result).
+
+    """
+    m = A.shape[0]
+    m2 = m*m
+    if out is None or not out.flags.c_contiguous:
+        # Reshaping a non-contiguous array gives a copy, which matmul would write into instead of out
+        out = np.empty(A.shape,dtype=np.result_type(A,B))
+    if pair == 'first':
+        np.matmul(B.T,A.reshape(m,m,m2),out=out.reshape(m,m,m2))        # B[l,j]*A[i,l,k,q]
+    else:
+        np.matmul(A.reshape(m2*m,m),B,out=out.reshape(m2*m,m))          # A[i,j,k,l]*B[l,q]
+        out -= np.matmul(B,A.reshape(m2,m,m)).reshape(A.shape)          # B[k,l]*A[i,j,l,q]
+    if pair == None:
+        out += np.matmul(B.T,A.reshape(m,m,m2)).reshape(A.shape)
+    if pair != 'second':
+        out -= np.dot(B,A.reshape(m,m2*m)).reshape(A.shape)             # B[i,l]*A[l,j,k,q]
+    return out
+
+def _con42_NO_einsum(A,B,state,pair=None):
+    """ Normal-ordering corrections for a rank-4 tensor and a matrix, computed without branching.
+
+        The occupation factor (state[k]-state[q]) is folded into the matrix B once, giving a weight
+        matrix W[k,q] = B[q,k]*(state[k]-state[q]) which is zero wherever state[k]==state[q]. Each
+        term is then a single contraction of A with W, using cached paths (see _con42_NO_exprs).
+
+    """
+    state = np.asarray(state)
+    W = B.T*(state[:,None]-state[None,:])
+    e1,e2,e3,e4 = _con42_NO_exprs(B.shape[0])
+    if pair == 'first':
+        return e2(A,W)
+    elif pair == 'second':
+        return e1(A,W)
+    con = e1(A,W)
+    con += e2(A,W)
+    con -= e3(A,W)
+    con += e4(A,W)
+    return con
+
+def _con44_NO_einsum(A,B,state):
+    """ Normal-ordering corrections for two rank-4 tensors, computed as a sequence of tensor contractions.
+
+        The 24 terms of con_jit44_NO fall into four groups related by exchanging indices of the output
+        (j<->q, i<->k, or both) with a sign. Only the first group, S, is contracted explicitly, using 
+        the combinations of B
+            P[a,b,c,d] = B[a,b,c,d]+B[c,d,a,b]-B[a,d,c,b]+B[c,b,a,d]
+            Q[a,b,c,d] = B[a,b,c,d]+B[a,d,c,b]
+            R[a,b,c,d] = B[a,b,c,d]+B[c,b,a,d]
+        and the remaining groups are obtained from transposes of S.
+
+        Only array methods and operators are used, so A, B and state may be NumPy or CuPy arrays.
+
+    """
+    Wd = 0.25*(state[:,None]-state[None,:])
+    Ws = 0.25*(state[:,None]+state[None,:])
+    P = B + B.transpose(2,3,0,1) - B.transpose(0,3,2,1) + B.transpose(2,1,0,3)
+    Q = B + B.transpose(0,3,2,1)
+    R = B + B.transpose(2,1,0,3)
+
+    e1,e2,e3,e4,e5,e6 = _con44_NO_exprs(A.shape[0])
+    S = e1(A,Wd,P)
+    S += e2(A,Wd,P)
+    S -= e3(A,Wd,P)
+    S -= e4(A,Wd,P)
+    S += e5(A,Ws,Q)
+    S += e6(A,Ws,R)
+
+    return S - S.transpose(0,3,2,1) - S.transpose(2,1,0,3) + S.transpose(2,3,0,1)
+
+def _zeros(out,shape,dtype=np.float64):
+    """ Returns out, reset to zero, if it is given, and otherwise allocates a new array of zeros. """
+    if out is None:
+        return np.zeros(shape,dtype=dtype)
+    out.fill(0)
+    return out
+
+def _result(con,out):
+    """ Returns the result of a contraction, copying it into out if an output buffer was given but not used. """
+    if out is None:
+        return np.asarray(con)
+    if con is not out:
+        out[...] = con
+    return out
 
 #------------------------------------------------------------------------------
 # Tensor contraction subroutines
 
 # General contraction function
-def contract(A,B,method='jit',comp=False,eta=False,pair=None):
-    """ General contract function: gets shape and calls appropriate contraction function. """
+@_limit_blas('jit')
+def contract(A,B,method='jit',comp=False,eta=False,pair=None,out=None):
+    """ General contract function: gets shape and calls appropriate contraction function. 
+
+        If out is given (a C-contiguous array of the same shape and dtype as the result), the result is 
+        written into it and out is returned, so that repeated calls can re-use a single buffer.
+
+    """
     # A = A.astype(np.float64)
     # B = B.astype(np.float64)
     if A.ndim == B.ndim == 2:
-        con = con22(A,B,method,comp,eta)
+        con = con22(A,B,method,comp,eta,out=out)
     if A.ndim != B.ndim:
         if A.ndim == 4:
             if B.ndim == 2:
                 if pair == None:
-                    con = con42(A,B,method=method,comp=comp,eta=eta)
+                    con = con42(A,B,method=method,comp=comp,eta=eta,out=out)
                 elif pair == 'first':
                     con = con42_firstpair(A,B,method,comp)
                 elif pair == 'second':
@@ -59,24 +261,64 @@ def contract(A,B,method='jit',comp=False,eta=False,pair=None):
         if A.ndim == 2:
             if B.ndim == 4:
                 if pair == None:
-                    con = con24(A,B,method=method,comp=comp,eta=eta)
+                    con = con24(A,B,method=method,comp=comp,eta=eta,out=out)
                 elif pair == 'first':
                     con = con24_firstpair(A,B,method,comp)
                 elif pair == 'second':
                     con = con24_secondpair(A,B,method,comp)
     # print(get_num_threads())
     # print("Threading layer: %s" % threading_layer())
-    return np.array(con)
+    return _result(con,out)
+
+# Batched contraction function
+@_limit_blas('blas')
+def contract_batch(A,B,method='blas',comp=False,eta=False,out=None):
+    """ Contracts a stack of independent pairs of square matrices in a single call.
+
+        A and B are arrays of shape (b,m,m), or sequences of b matrices, and the result is an array C
+        of shape (b,m,m) with C[n] = A[n] @ B[n] - B[n] @ A[n]. Useful when the same contraction is 
+        needed for several independent channels (e.g. spin up and spin down).
+
+        With method='blas' (or 'tensordot'), np.matmul broadcasts over the leading axis so that all 
+        pairs are handled by one batched GEMM call; method='einsum' uses a cached opt_einsum path 
+        instead. These compute the full contraction, so eta and comp do not affect them. The loop-based 
+        methods ('jit', 'vec', 'cython') have no batched form, so each pair is passed to con22 in turn.
+
+    """
+    if method in ['einsum','tensordot','blas']:
+        A = np.asarray(A)
+        B = np.asarray(B)
+        if method == 'einsum':
+            e = _batch_expr(A.shape)
+            con = e(A,B,out=out)
+            con -= e(B,A)
+        else:
+            con = np.matmul(A,B,out=out)
+            con -= np.matmul(B,A)
+        return _result(con,out)
+
+    if out is None:
+        out = np.empty((len(A),)+A[0].shape,dtype=np.complex128 if comp else np.float64)
+    for n in range(len(A)):
+        con22(A[n],B[n],method,comp,eta,out=out[n])
+    return out
 
 # Normal-ordering contraction function
-def contractNO(A,B,method='jit',comp=False,eta=False,state=[],upstate=[],downstate=[],pair=None):
-    """ General normal-ordering function: gets shape and calls appropriate contraction function. """
+@_limit_blas('jit')
+def contractNO(A,B,method='jit',comp=False,eta=False,state=[],upstate=[],downstate=[],pair=None,out=None,precision='double'):
+    """ General normal-ordering function: gets shape and calls appropriate contraction function. 
+
+        If out is given, the result is written into it and out is returned (see contract).
+
+    """
+    if method == 'cuda' and not (A.ndim == B.ndim == 4 and pair == None):
+        raise ValueError("method='cuda' is only available for two rank-4 tensors with pair=None (see con44_NO)")
 
     if A.ndim == B.ndim == 2:
         con = 0
     elif A.ndim == B.ndim == 4 and method == 'jit':
         if A.ndim == B.ndim == 4 and pair==None:
-            con = con44_NO(A,B,method=method,comp=comp,eta=eta,state=state)
+            con = con44_NO(A,B,method=method,comp=comp,eta=eta,state=state,out=out,precision=precision)
         elif A.ndim == B.ndim == 4 and pair=='up-mixed':
             con = con_jit44_NO_up_mixed(A,B,state=state)
         elif A.ndim == B.ndim == 4 and pair=='down-mixed':
@@ -92,9 +334,12 @@ def contractNO(A,B,method='jit',comp=False,eta=False,state=[],upstate=[],downsta
         elif A.ndim == B.ndim == 4 and pair=='mixed':
             con = con_jit44_NO_mixed(A,B,upstate=upstate,downstate=downstate)
         
+    elif A.ndim == B.ndim == 4 and method in ['einsum','tensordot','blas','cuda'] and pair == None:
+        con = con44_NO(A,B,method=method,comp=comp,eta=eta,state=state,out=out,precision=precision)
+
     elif A.ndim == B.ndim == 4 and method == 'vec':
         if A.ndim == B.ndim == 4 and pair == None:
-            con = con44_NO(A,B,method=method,comp=comp,eta=eta,state=state)
+            con = con44_NO(A,B,method=method,comp=comp,eta=eta,state=state,out=out,precision=precision)
         elif A.ndim == B.ndim == 4 and pair=='up-mixed':
             con = np.zeros(A.shape,dtype=np.float64)
             con_vec44_NO_up_mixed(A,B,state,con)
@@ -123,7 +368,7 @@ def contractNO(A,B,method='jit',comp=False,eta=False,state=[],upstate=[],downsta
 
     elif A.ndim == B.ndim == 4 and method == 'cython':
         if A.ndim == B.ndim == 4 and pair == None:
-            con = con44_NO(A,B,method=method,comp=comp,eta=eta,state=state)
+            con = con44_NO(A,B,method=method,comp=comp,eta=eta,state=state,out=out,precision=precision)
         elif A.ndim == B.ndim == 4 and pair=='up-mixed':
             con = np.zeros(A.shape,dtype=np.float64)
             con = cycon_44_NO_up_mixed(A,B,state,con)
@@ -159,8 +404,9 @@ def contractNO(A,B,method='jit',comp=False,eta=False,state=[],upstate=[],downsta
         elif A.ndim == 2:
             if B.ndim == 4:
                 con = con24_NO(A,B,method=method,comp=comp,state=state,pair=pair)
-    return np.array(con)
+    return _result(con,out)
 
+@_limit_blas('jit')
 def contractNO2(A,B,method='jit',comp=False,eta=False,state=[],pair=None):
     """ General normal-ordering function: gets shape and calls appropriate contraction function. """
 
@@ -174,7 +420,7 @@ def contractNO2(A,B,method='jit',comp=False,eta=False,state=[],pair=None):
     return np.array(con)
 
 # Contract square matrices (matrix multiplication)
-def con22(A,B,method='jit',comp=False,eta=False):
+def con22(A,B,method='jit',comp=False,eta=False,out=None):
     """ Contraction function for matrices.
     
         Takes two input matrices, A and B, and contracts them according to the specified method.
@@ -187,8 +433,8 @@ def con22(A,B,method='jit',comp=False,eta=False):
             Input matrix.
         method : string, optional
             Defines which contraction method to use.
-            Method choices are 'einsum', 'tensordot', 'jit' and 'vec'.
-            The first two are built-in NumPy methods, while the latter two are custom coded for speed.
+            Method choices are 'einsum', 'tensordot', 'blas', 'jit' and 'vec'.
+            The first three are built-in NumPy methods, while the latter two are custom coded for speed.
             (Specifially, they only compute half of the contraction and (anti)symmetrically copy it 
             to the other half.)
         comp : Bool, optional
@@ -198,50 +444,52 @@ def con22(A,B,method='jit',comp=False,eta=False):
             If method is 'jit' or 'vectorize' and eta=True, the resulting matrix will be antisymmetrised.
             Otherwise, the result will be symmetric. Methods 'einsum' and 'tensordot' compute the full 
             matrix contraction and do not make use of symmetries, so this parameter does not affect them.
+        out : array, optional
+            Pre-allocated (C-contiguous) array to write the result into, which is then returned.
     
     """
 
     if method == 'einsum':
-        return np.einsum('ij,jk->ik',A,B,optimize=True) - np.einsum('ki,ij->kj',B,A,optimize=True)
+        # A two-operand contraction has no path to optimise, so call matmul directly
+        con = np.matmul(A,B,out=out)
+        con -= B @ A
     elif method == 'tensordot':
-        return np.tensordot(A,B,axes=1) - np.tensordot(B,A,axes=1)
+        # Subtract in place rather than allocating a third matrix for the difference
+        con = np.tensordot(A,B,axes=1)
+        con = np.subtract(con,np.tensordot(B,A,axes=1),out=con if out is None else out)
+    elif method == 'blas':
+        con = _con22_blas(A,B,out=out)
     elif method == 'jit' and comp==False:
-        con = np.zeros(A.shape,dtype=np.float64)
+        con = _zeros(out,A.shape)
         if eta==False:
-            return con_jit(A,B,con)
+            con_jit(A,B,con)
         elif eta==True:
-            return con_jit_anti(A,B,con)
+            con_jit_anti(A,B,con)
     elif method == 'jit' and comp==True:
+        con = _zeros(out,A.shape,dtype=np.complex128)
+        A = A.astype(np.complex128,copy=False)
+        B = B.astype(np.complex128,copy=False)
         if eta == False:
-            return con_jit_comp(A,B)
+            con_jit_comp(A,B,con)
         else:
-            return con_jit_anti_comp(A,B)
+            con_jit_anti_comp(A,B,con)
     elif method == 'vec' and comp == False:
-        con = np.zeros(A.shape)
+        con = _zeros(out,A.shape)
         if eta == False:
             con_vec(A,B,con)
         elif eta == True:
             con_vec_anti(A,B,con)
-        return con
     elif method == 'vec' and comp == True:
-        if A.dtype==np.complex128 and B.dtype==np.complex128:
-            con = np.zeros(A.shape,dtype=np.complex128)
-            con_vec_comp2(A,B,con)
-        elif A.dtype == np.complex128 and B.dtype == np.float64:
-            con = np.zeros(A.shape,dtype=np.complex128)
-            con_vec_comp(A,B,con)
-        elif A.dtype == np.float64 and B.dtype == np.complex128:
-            con = np.zeros(A.shape,dtype=np.complex128)
-            con_vec_comp3(A,B,con)
-        return con
+        con = _zeros(out,A.shape,dtype=np.result_type(A,B))
+        con_vec_comp(A,B,con)
     elif method == 'cython':
-        con = np.zeros(A.shape)
+        con = _zeros(out,A.shape)
         con = cycon22(A,B,con)
         
-        return np.array(con)
+    return _result(con,out)
     
 # Contract rank-4 tensor with square matrix
-def con42(A,B,method='jit',comp=False,eta=False):
+def con42(A,B,method='jit',comp=False,eta=False,out=None,sym=None):
     """ Contraction function for a rank-4 tensor and a matrix (rank-2 tensor).
 
     Takes two input arrays, A and B, and contracts them according to the specified method.
@@ -255,10 +503,12 @@ def con42(A,B,method='jit',comp=False,eta=False):
         Input matrix.
     method : string, optional
         Defines which contraction method to use.
-        Method choices are 'einsum', 'tensordot', 'jit' and 'vec'.
-        The first two are built-in NumPy methods, while the latter two are custom coded for speed.
+        Method choices are 'einsum', 'tensordot', 'blas', 'jit' and 'vec'.
+        The first three are built-in NumPy methods, while the latter two are custom coded for speed.
         (Specifially, they only compute half of the contraction and (anti)symmetrically copy it 
-        to the other half.)
+        to the other half.) The 'einsum' method uses opt_einsum contraction paths which are 
+        computed once per system size and cached (see _con42_exprs), while 'blas' reshapes A 
+        so that each term is a single matrix multiplication (see _con42_blas).
     comp : Bool, optional
         If method is 'jit' or 'vectorize' and either matrix is complex, comp=True will call a 
         contraction subroutine that complex conjugates appropriate terms without computing them.
@@ -266,49 +516,74 @@ def con42(A,B,method='jit',comp=False,eta=False):
         If method is 'jit' or 'vectorize' and eta=True, the resulting matrix will be antisymmetrised.
         Otherwise, the result will be symmetric. Methods 'einsum' and 'tensordot' compute the full 
         matrix contraction and do not make use of symmetries, so this parameter does not affect them.
+    out : array, optional
+        Pre-allocated (C-contiguous) array to write the result into, which is then returned.
+    sym : string, optional
+        Pair-exchange symmetry of A, which the contraction preserves. If method is 'jit' and sym is 
+        'pair' (A[i,j,k,q] = A[k,q,i,j]) or 'antipair' (A[i,j,k,q] = -A[k,q,i,j]), only half of the 
+        result is computed and the other half is copied. The symmetry is assumed, not checked. 
+        Other methods ignore this parameter.
     
     """
 
+    # Inputs sliced or transposed upstream may not be C-contiguous; copy them once here so that the 
+    # reshapes used by the 'blas' method are views and the loop-based methods stride through memory in order.
+    A = np.ascontiguousarray(A)
+    B = np.ascontiguousarray(B)
+
     if method == 'einsum':
-        con = np.einsum('abcd,df->abcf',A,B) 
-        con += -np.einsum('abcd,ec->abed',A,B)
-        con += np.einsum('abcd,bf->afcd',A,B)
-        con += -np.einsum('abcd,ea->ebcd',A,B)
+        e1,e2,e3,e4 = _con42_exprs(A.shape[0])
+        con = e1(A,B,out=out)
+        con -= e2(A,B)
+        con += e3(A,B)
+        con -= e4(A,B)
 
     elif method == 'tensordot':
-        con = - np.moveaxis(np.tensordot(A,B,axes=[0,1]),[0,1,2,3],[1,2,3,0])
-        con += - np.moveaxis(np.tensordot(A,B,axes=[2,1]),[0,1,2,3],[0,1,3,2])
-        con += np.moveaxis(np.tensordot(A,B,axes=[1,0]),[0,1,2,3],[0,2,3,1])
-        con += np.tensordot(A,B,axes=[3,0])
+        # Contracting the last index of A, or the first index of A with B on the left, gives the result 
+        # in (i,j,k,q) order directly; the two middle-index terms use the cached einsum paths.
+        e1,e2,e3,e4 = _con42_exprs(A.shape[0])
+        con = np.tensordot(A,B,axes=[3,0])
+        con -= e2(A,B)
+        con += e3(A,B)
+        con -= np.tensordot(B,A,axes=[1,0])
+    elif method == 'blas':
+        con = _con42_blas(A,B,out=out)
     elif method == 'jit' and comp == False:
-        con = con_jit42(A,B)
+        con = out if out is not None else np.empty(A.shape,dtype=np.float64)
+        if sym == 'pair':
+            con_jit42_pair(A,B,con,1.)
+        elif sym == 'antipair':
+            con_jit42_pair(A,B,con,-1.)
+        else:
+            con_jit42(A,B,con)
     elif method == 'jit' and comp == True:
-        con = con_jit42_comp(A,B)
+        con = out if out is not None else np.empty(A.shape,dtype=np.complex128)
+        con_jit42_comp(A,B,con)
     elif method == 'vec' and comp == False:
-        con = np.zeros(A.shape,dtype=np.float64)
+        con = _zeros(out,A.shape)
         # if eta == False:
         con_vec42(A,B,con)
         # elif eta == True:
         #     con_vec42_anti(A,B,con)
     elif method == 'vec' and comp == True:
-        con = np.zeros(A.shape,dtype=np.complex128)
-        if A.dtype == np.float64 and B.dtype==np.complex128:
-            con_vec42_comp(A,B,con)
-        elif A.dtype == np.complex128 and B.dtype==np.float64:
-            con_vec42_comp2(A,B,con)
-        elif A.dtype == np.complex128 and B.dtype==np.complex128:
-            con_vec42_comp3(A,B,con)
+        con = _zeros(out,A.shape,dtype=np.result_type(A,B))
+        con_vec42_comp(A,B,con)
 
     elif method == 'cython':
-        con = np.zeros(A.shape,dtype=np.float64)
+        con = _zeros(out,A.shape)
         con = cycon_42(A,B,con)
 
-    return np.array(con)
+    return _result(con,out)
 
 # Contract square matrix with rank-4 tensor
-def con24(A,B,method='jit',comp=False,eta=False):
-    """ Utility function to flip the order of matrix and tensor and re-use the function con42. """
-    return -con42(B,A,method=method,comp=comp,eta=eta)
+def con24(A,B,method='jit',comp=False,eta=False,out=None):
+    """ Utility function to flip the order of matrix and tensor and re-use the function con42. 
+
+        The contraction is linear in the matrix, so the sign is applied to the (m,m) matrix A rather 
+        than to the (m,m,m,m) result.
+
+    """
+    return con42(B,-A,method=method,comp=comp,eta=eta,out=out)
 
 # Double-contract rank-4 tensor with square matrix
 def con42_NO(A,B,method='jit',comp=False,state=[],pair=None):
@@ -342,14 +617,8 @@ def con42_NO(A,B,method='jit',comp=False,state=[],pair=None):
     
     """
 
-    if method == 'einsum':
-        print('N/O CORRECTIONS NOT POSSIBLE WITH EINSUM')
-        print('*** Switching method to jit ***')
-        method = 'jit'
-    elif method == 'tensordot':
-        print('N/O CORRECTIONS NOT POSSIBLE WITH TENSORDOT')
-        print('*** Switching method to jit ***')
-        method = 'jit'
+    if method in ['einsum','tensordot','blas']:
+        con = _con42_NO_einsum(A,B,state,pair)
     elif method == 'jit' and comp == False:
         # print('jit')
         if pair == None:
@@ -387,7 +656,7 @@ def con24_NO(A,B,method='jit',comp=False,eta=False,state=[],pair=None):
     return -con42_NO(B,A,method,comp,state,pair)
 
 # Double-contract rank-4 tensor with square matrix
-def con44_NO(A,B,method='jit',comp=False,eta=False,state=[]):
+def con44_NO(A,B,method='jit',comp=False,eta=False,state=[],out=None,precision='double'):
     """ Normal-ordering correction function for two rank-4 tensors.
 
     Takes two input arrays, A and B, and performs all 2-body contractions according to the 
@@ -401,10 +670,10 @@ def con44_NO(A,B,method='jit',comp=False,eta=False,state=[]):
         Input matrix.
     method : string, optional
         Defines which contraction method to use.
-        Method choices are 'einsum', 'tensordot', 'jit' and 'vec'.
-        The first two are built-in NumPy methods, while the latter two are custom coded for speed.
-        (Specifially, they only compute half of the contraction and (anti)symmetrically copy it 
-        to the other half.)
+        Method choices are 'einsum', 'tensordot', 'blas', 'jit', 'vec', 'cython' and 'cuda'. 
+        The first three evaluate the corrections as a sequence of tensor contractions with cached 
+        paths (see _con44_NO_einsum), and 'cuda' (requires CuPy) does the same on the GPU. 
+        The others are custom coded loops.
     comp : Bool, optional
         If method is 'jit' or 'vectorize' and either matrix is complex, comp=True will call a 
         contraction subroutine that complex conjugates appropriate terms without computing them.
@@ -414,41 +683,62 @@ def con44_NO(A,B,method='jit',comp=False,eta=False,state=[]):
         matrix contraction and do not make use of symmetries, so this parameter does not affect them.
     state : array
         Reference state for the computation of normal-ordering corretions.
+    out : array, optional
+        Pre-allocated (C-contiguous) array to write the result into, which is then returned.
+    precision : string, optional
+        If method is 'jit' and precision='mixed', the combinations of B used in the inner loop are 
+        stored in single precision while the sum is accumulated in double precision. If method is 
+        'cuda' and precision='mixed', all of the contractions on the GPU are carried out in single 
+        precision (much faster than double precision on most consumer GPUs) and the result is 
+        returned in double precision. The default, 'double', uses double precision throughout.
     
     """
 
-    if method == 'einsum':
-        print('N/O CORRECTIONS NOT POSSIBLE WITH EINSUM')
-    elif method == 'tensordot':
-        print('N/O CORRECTIONS NOT POSSIBLE WITH TENSORDOT')
+    if method in ['einsum','tensordot','blas']:
+        con = _con44_NO_einsum(A,B,np.asarray(state,dtype=np.float64))
     elif method == 'jit' and comp == False:
         # if eta == False:
-        con = con_jit44_NO(A,B,state)
+        con = out if out is not None else np.empty(A.shape,dtype=np.float64)
+        if precision == 'mixed':
+            con_jit44_NO_fp32(A,B,state,con)
+        else:
+            con_jit44_NO(A,B,state,con)
     elif method == 'vec' and comp == False:
-        con = np.zeros(A.shape,dtype=np.float64)
+        con = _zeros(out,A.shape)
         con_vec44_NO(A,B,state,con)
     elif method == 'cython':
-        con = np.zeros(A.shape,dtype=np.float64)
+        con = _zeros(out,A.shape)
         con = cycon_44_NO(A,B,state,con)
+    elif method == 'cuda':
+        if cp is None:
+            raise ImportError("method='cuda' requires CuPy")
+        dtype = cp.float32 if precision == 'mixed' else cp.float64
+        con = _con44_NO_einsum(cp.asarray(A,dtype=dtype),cp.asarray(B,dtype=dtype),cp.asarray(state,dtype=dtype))
+        con = cp.asnumpy(con).astype(np.float64,copy=False)
 
-    return np.array(con)
+    return _result(con,out)
 
 # Contract rank-4 tensor with square matrix
 def con42_firstpair(A,B,method='jit',comp=False,eta=False):
     #print(psutil.cpu_percent(percpu=True))    
 # print('con42',A.dtype,B.dtype)
+    A = np.ascontiguousarray(A)
+    B = np.ascontiguousarray(B)
     if method == 'einsum':
         # print('einsum')
         # con = np.einsum('abcd,df->abcf',A,B,optimize=True) 
         # con += -np.einsum('abcd,ec->abed',A,B,optimize=True)
-        con = np.einsum('abcd,bf->afcd',A,B,optimize=True)
-        con += -np.einsum('abcd,ea->ebcd',A,B,optimize=True)
+        _,_,e3,e4 = _con42_exprs(A.shape[0])
+        con = e3(A,B)
+        con -= e4(A,B)
     elif method == 'tensordot':
         # print('tensordot')
         con = - np.moveaxis(np.tensordot(A,B,axes=[0,1]),[0,1,2,3],[1,2,3,0])
         # con += - np.moveaxis(np.tensordot(A,B,axes=[2,1]),[0,1,2,3],[0,1,3,2])
         con += np.moveaxis(np.tensordot(A,B,axes=[1,0]),[0,1,2,3],[0,2,3,1])
         # con += np.tensordot(A,B,axes=[3,0])
+    elif method == 'blas':
+        con = _con42_blas(A,B,pair='first')
     elif method == 'jit':
         con = con_jit42_firstpair(A,B)
     elif method == 'vec':
@@ -462,10 +752,13 @@ def con42_firstpair(A,B,method='jit',comp=False,eta=False):
 # Contract rank-4 tensor with square matrix
 def con42_secondpair(A,B,method='jit',comp=False,eta=False):
 
+    A = np.ascontiguousarray(A)
+    B = np.ascontiguousarray(B)
     if method == 'einsum':
         # print('einsum')
-        con = np.einsum('abcd,df->abcf',A,B,optimize=True) 
-        con += -np.einsum('abcd,ec->abed',A,B,optimize=True)
+        e1,e2,_,_ = _con42_exprs(A.shape[0])
+        con = e1(A,B)
+        con -= e2(A,B)
         # con += np.einsum('abcd,bf->afcd',A,B,optimize=True)
         # con += -np.einsum('abcd,ea->ebcd',A,B,optimize=True)
     elif method == 'tensordot':
@@ -474,6 +767,8 @@ def con42_secondpair(A,B,method='jit',comp=False,eta=False):
         con = - np.moveaxis(np.tensordot(A,B,axes=[2,1]),[0,1,2,3],[0,1,3,2])
         # con += np.moveaxis(np.tensordot(A,B,axes=[1,0]),[0,1,2,3],[0,2,3,1])
         con += np.tensordot(A,B,axes=[3,0])
+    elif method == 'blas':
+        con = _con42_blas(A,B,pair='second')
     elif method == 'jit':
         con = con_jit42_secondpair(A,B)
     elif method == 'vec':
@@ -486,7 +781,7 @@ def con42_secondpair(A,B,method='jit',comp=False,eta=False):
 
 
 def con24_firstpair(A,B,method='jit',comp=False,eta=False):
-    return -con42_firstpair(B,A,method,comp,eta)
+    return con42_firstpair(B,-A,method,comp,eta)
 
 def con24_secondpair(A,B,method='jit',comp=False,eta=False):
-    return -con42_secondpair(B,A,method,comp,eta)
\ No newline at end of file
+    return con42_secondpair(B,-A,method,comp,eta)
\ No newline at end of file
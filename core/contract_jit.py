@@ -28,14 +28,17 @@ This file contains all of the matrix/tensor contraction routines used to compute
 
 import os
 from psutil import cpu_count
-# Set up threading options for parallel solver
-os.environ['OMP_NUM_THREADS']= str(int(cpu_count(logical=False))) # Set number of OpenMP threads
-os.environ['MKL_NUM_THREADS']= str(int(cpu_count(logical=False))) # Set number of MKL threads
-os.environ['NUMBA_NUM_THREADS'] = str(int(cpu_count(logical=False))) # Set number of Numba threads
 import numpy as np
-from numba import jit,prange,float64
+from numba import jit,prange,float32,float64,set_num_threads,config
 # from numba import get_num_threads,threading_layer
 
+# Run parallel (prange) loops on the physical cores only, within the limits set by NUMBA_NUM_THREADS 
+# and the CPU affinity of this process
+_nthreads = min(int(cpu_count(logical=False)),config.NUMBA_NUM_THREADS)
+if hasattr(os,'sched_getaffinity'):
+    _nthreads = min(_nthreads,len(os.sched_getaffinity(0)))
+set_num_threads(max(1,_nthreads))
+
 #------------------------------------------------------------------------------
 # jit functions which return a matrix
     
@@ -62,10 +65,9 @@ def con_jit_anti(A,B,C):
             C[j,i] = -C[i,j]
     return C
 
-@jit(nopython=True,parallel=True,fastmath=True,cache=True)
-def con_jit_comp(A,B):
+@jit(nopython=True,parallel=True,cache=True)
+def con_jit_comp(A,B,C):
     """ Contract two square complex matrices. Computes upper half only and then symmetrises. """
-    C = np.zeros(A.shape,dtype=np.complex64)
     m,_=A.shape
     for i in prange(m):
         for j in range(i,m):
@@ -75,10 +77,9 @@ def con_jit_comp(A,B):
 
     return C
 
-@jit(nopython=True,parallel=True,fastmath=True,cache=True)
-def con_jit_anti_comp(A,B):
+@jit(nopython=True,parallel=True,cache=True)
+def con_jit_anti_comp(A,B,C):
     """ Contract two square complex matrices. Computes upper half only and then anti-symmetrises. """
-    C = np.zeros(A.shape,dtype=np.complex64)
     m,_=A.shape
     for i in prange(m):
         for j in range(i,m):
@@ -90,18 +91,25 @@ def con_jit_anti_comp(A,B):
 
 @jit(float64[:,:](float64[:,:,:,:],float64[:,:],float64[:]),nopython=True,parallel=True,fastmath=True,cache=True)
 def con_jit42_NO(A,B,state):
-    """ 2-point contractions of a rank-4 tensor with a square matrix. Computes upper half only and then symmetrises. """
+    """ 2-point contractions of a rank-4 tensor with a square matrix.
+
+        The occupation factor is folded into a weight matrix W[k,q] = B[q,k]*(state[k]-state[q]) 
+        before the main loop, so the inner loop contains no branches.
+
+    """
     C = np.zeros(B.shape,dtype=np.float64)
     m,_=B.shape
-    for i in range(m):
+    W = np.zeros(B.shape,dtype=np.float64)
+    for k in range(m):
+        for q in range(m):
+            W[k,q] = B[q,k]*(state[k]-state[q])
+    for i in prange(m):
         for j in range(m):
+            acc = 0.
             for k in range(m):
                 for q in range(m):
-                    if state[k] != state[q]:
-                        C[i,j] += A[i,j,k,q]*B[q,k]*(state[k]-state[q])
-                        C[i,j] += A[k,q,i,j]*B[q,k]*(state[k]-state[q])
-                        C[i,j] += -A[k,j,i,q]*B[q,k]*(state[k]-state[q])
-                        C[i,j] += A[i,q,k,j]*B[q,k]*(state[k]-state[q])
+                    acc += (A[i,j,k,q]+A[k,q,i,j]-A[k,j,i,q]+A[i,q,k,j])*W[k,q]
+            C[i,j] = acc
 
     return C
 
@@ -156,39 +164,59 @@ def con_jit42_comp_NO(A,B,state):
 #------------------------------------------------------------------------------
 # jit functions which return a rank-4 tensor
 
-@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:]),nopython=True,parallel=True,fastmath=True,cache=True,nogil=True)
-def con_jit42(A,B):
-    C = np.zeros(A.shape,dtype=np.float64)
+@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:],float64[:,:,:,:]),nopython=True,parallel=True,fastmath=True,cache=True,nogil=True,boundscheck=False)
+def con_jit42(A,B,C):
+    """ Contract a rank-4 tensor with a square matrix into C. Each element is summed in a local accumulator and stored once. """
     m,_,_,_=A.shape
     for i in prange(m):
         for j in range(m):
             for k in range(m):
                 for q in range(m):
-                    C[i,j,k,q] = 0.
+                    acc = 0.
+                    for l in range(m):
+                        acc += A[i,j,k,l]*B[l,q] - A[i,j,l,q]*B[k,l] + A[i,l,k,q]*B[l,j] - A[l,j,k,q]*B[i,l]
+                    C[i,j,k,q] = acc
+
+    return C
+
+@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:],float64[:,:,:,:],float64),nopython=True,parallel=True,fastmath=True,cache=True,nogil=True,boundscheck=False)
+def con_jit42_pair(A,B,C,sign):
+    """ As con_jit42, for a tensor A with A[i,j,k,q] = sign*A[k,q,i,j], which the contraction preserves.
+
+        Only the elements with (k,q) >= (i,j) in row-major order are computed; the rest are copied
+        with the given sign, roughly halving the work.
+
+    """
+    m,_,_,_=A.shape
+    for i in prange(m):
+        for j in range(m):
+            for k in range(i,m):
+                q0 = j if k == i else 0
+                for q in range(q0,m):
+                    acc = 0.
                     for l in range(m):
-                        C[i,j,k,q] += A[i,j,k,l]*B[l,q] 
-                        C[i,j,k,q] += -A[i,j,l,q]*B[k,l]
-                        C[i,j,k,q] += A[i,l,k,q]*B[l,j]
-                        C[i,j,k,q] += -A[l,j,k,q]*B[i,l] 
+                        acc += A[i,j,k,l]*B[l,q] - A[i,j,l,q]*B[k,l] + A[i,l,k,q]*B[l,j] - A[l,j,k,q]*B[i,l]
+                    C[k,q,i,j] = sign*acc
+                    C[i,j,k,q] = acc
 
     return C
 
-@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:]),nopython=True,parallel=True,fastmath=True,cache=True,nogil=True)
+@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:]),nopython=True,parallel=True,fastmath=True,cache=True,nogil=True,boundscheck=False)
 def con_jit42_firstpair(A,B):
     C = np.zeros(A.shape,dtype=np.float64)
     m,_,_,_=A.shape
-    for i in range(m):
+    for i in prange(m):
         for j in range(m):
             for k in range(m):
                 for q in range(m):
-                    C[i,j,k,q] = 0.
+                    acc = 0.
                     for l in range(m):
-                        C[i,j,k,q] += A[i,l,k,q]*B[l,j]
-                        C[i,j,k,q] += -A[l,j,k,q]*B[i,l] 
+                        acc += A[i,l,k,q]*B[l,j] - A[l,j,k,q]*B[i,l]
+                    C[i,j,k,q] = acc
 
     return C
 
-@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:]),nopython=True,parallel=True,fastmath=True,cache=True,nogil=True)
+@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:]),nopython=True,parallel=True,fastmath=True,cache=True,nogil=True,boundscheck=False)
 def con_jit42_secondpair(A,B):
     C = np.zeros(A.shape,dtype=np.float64)
     m,_,_,_=A.shape
@@ -196,74 +224,138 @@ def con_jit42_secondpair(A,B):
         for j in range(m):
             for k in range(m):
                 for q in range(m):
-                    C[i,j,k,q] = 0.
+                    acc = 0.
                     for l in range(m):
-                        C[i,j,k,q] += A[i,j,k,l]*B[l,q] 
-                        C[i,j,k,q] += -A[i,j,l,q]*B[k,l]
+                        acc += A[i,j,k,l]*B[l,q] - A[i,j,l,q]*B[k,l]
+                    C[i,j,k,q] = acc
 
     return C
 
-@jit(nopython=True,parallel=True,fastmath=True,cache=True)
-def con_jit42_comp(A,B):
-    C = np.zeros(A.shape,dtype=np.complex64)
+@jit(nopython=True,parallel=True,cache=True,boundscheck=False)
+def con_jit42_comp(A,B,C):
+    """ Contract a (complex) rank-4 tensor with a (complex) square matrix into C. Each element is summed in a local accumulator and stored once. """
     m,_,_,_=A.shape
     for i in prange(m):
         for j in range(m):
             for k in range(m):
                 for q in range(m):
+                    acc = 0j
                     for l in range(m):
-                        C[i,j,k,q] += A[i,j,k,l]*B[l,q] 
-                        C[i,j,k,q] += -A[i,j,l,q]*B[k,l]
-                        C[i,j,k,q] += A[i,l,k,q]*B[l,j]
-                        C[i,j,k,q] += -A[l,j,k,q]*B[i,l] 
+                        acc += A[i,j,k,l]*B[l,q] - A[i,j,l,q]*B[k,l] + A[i,l,k,q]*B[l,j] - A[l,j,k,q]*B[i,l]
+                    C[i,j,k,q] = acc
 
     return C
 
-@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:,:,:],float64[:]),nopython=True,parallel=True,fastmath=True,cache=True)
-def con_jit44_NO(A,B,state):
-    C = np.zeros(A.shape,dtype=np.float64)
+@jit(nopython=True,parallel=True,fastmath=True,cache=True)
+def con_jit44_NO_combine(B,P,Q,R):
+    """ Pre-computes the combinations of elements of B which appear in con_jit44_NO.
+
+        Each combination is stored with the summed indices (l,m) as the last two axes, so that
+        the innermost loops of con_jit44_NO read them contiguously. The three arrays are written 
+        into P, Q and R, whose dtype sets the precision in which they are stored:
+
+            P[c,d,l,m] = B[m,l,c,d]+B[c,d,m,l]-B[m,d,c,l]+B[c,l,m,d]
+            Q[a,c,l,m] = B[a,m,c,l]+B[a,l,c,m]
+            R[b,d,l,m] = B[m,b,l,d]+B[l,b,m,d]
+
+    """
+    m0,_,_,_=B.shape
+    for c in prange(m0):
+        for d in range(m0):
+            for l in range(m0):
+                for m in range(m0):
+                    P[c,d,l,m] = B[m,l,c,d]+B[c,d,m,l]-B[m,d,c,l]+B[c,l,m,d]
+                    Q[c,d,l,m] = B[c,m,d,l]+B[c,l,d,m]
+                    R[c,d,l,m] = B[m,c,l,d]+B[l,c,m,d]
+
+@jit([float64[:,:,:,:](float64[:,:,:,:],float64[:,:,:,:],float64[:,:,:,:],float64[:,:,:,:],float64[:],float64[:,:,:,:]),
+      float64[:,:,:,:](float64[:,:,:,:],float32[:,:,:,:],float32[:,:,:,:],float32[:,:,:,:],float64[:],float64[:,:,:,:])],
+      nopython=True,parallel=True,fastmath=True,cache=True)
+def con_jit44_NO_loop(A,P,Q,R,state,C):
+    """ Main loop of con_jit44_NO, given the combinations of B from con_jit44_NO_combine.
+
+        The 24 terms fall into four groups related by exchanging j<->q, i<->k, or both, with a sign.
+        Only the first group, S, is summed over (l,m) and written into C; the result 
+            C[i,j,k,q] = S[i,j,k,q] - S[i,q,k,j] - S[k,j,i,q] + S[k,q,i,j]
+        is then assembled in place, one set of four related elements at a time. The four elements 
+        are equal up to sign, and vanish if i==k or j==q. This needs a quarter of the arithmetic 
+        and no temporary arrays.
+
+        The occupation factors (state[l]-state[m]), (state[l]+state[m]) are computed once before the
+        main loop rather than for every (i,j,k,q). Terms with state[l]==state[m] carry a zero occupation
+        factor, so no branch is needed in the inner loop. The combinations of B may be stored in double
+        or single precision; the sum is always accumulated in double precision.
+
+    """
     m0,_,_,_=A.shape
+    Wd = np.zeros((m0,m0),dtype=np.float64)
+    Ws = np.zeros((m0,m0),dtype=np.float64)
+    for l in range(m0):
+        for m in range(m0):
+            Wd[l,m] = 0.25*(state[l]-state[m])
+            Ws[l,m] = 0.25*(state[l]+state[m])
+
     for i in prange(m0):
         for j in range(m0):
             for k in range(m0):
                 for q in range(m0):
-                        # Indices to be summed over
-                        for l in range(m0):
-                            for m in range(m0):
-                                if state[l] != state[m]:
-                                    C[i,j,k,q] += 0.25*A[i,j,l,m]*(B[m,l,k,q]+B[k,q,m,l]-B[m,q,k,l]+B[k,l,m,q])*(state[l]-state[m]) #+
-                                    C[i,j,k,q] += 0.25*A[l,m,i,j]*(B[m,l,k,q]+B[k,q,m,l]-B[m,q,k,l]+B[k,l,m,q])*(state[l]-state[m]) #+
-                                    C[i,j,k,q] += -0.25*A[l,j,i,m]*(B[m,l,k,q]+B[k,l,m,q]-B[m,q,k,l]+B[k,q,m,l])*(state[l]-state[m]) #-
-                                    C[i,j,k,q] += -0.25*A[i,l,m,j]*(B[k,m,l,q]+B[k,q,l,m]+B[l,m,k,q]-B[l,q,k,m])*(state[l]-state[m]) #-
-                                C[i,j,k,q] +=  0.25*A[l,j,m,q]*(B[i,m,k,l]+B[i,l,k,m])*(state[l]+state[m]) #--
-                                C[i,j,k,q] +=  0.25*A[i,l,k,m]*(B[m,j,l,q]+B[l,j,m,q])*(state[l]+state[m]) #--
-
-                                if state[l] != state[m]:
-                                    C[i,j,k,q] += -0.25*A[i,q,l,m]*(B[m,l,k,j]+B[k,j,m,l]-B[m,j,k,l]+B[k,l,m,j])*(state[l]-state[m]) #+
-                                    C[i,j,k,q] += -0.25*A[l,m,i,q]*(B[m,l,k,j]+B[k,j,m,l]-B[m,j,k,l]+B[k,l,m,j])*(state[l]-state[m]) #+
-                                    C[i,j,k,q] += 0.25*A[l,q,i,m]*(B[m,l,k,j]+B[k,l,m,j]-B[m,j,k,l]+B[k,j,m,l])*(state[l]-state[m]) #-
-                                    C[i,j,k,q] += 0.25*A[i,l,m,q]*(B[k,m,l,j]+B[k,j,l,m]+B[l,m,k,j]-B[l,j,k,m])*(state[l]-state[m]) #-
-                                C[i,j,k,q] +=  -0.25*A[l,q,m,j]*(B[i,m,k,l]+B[i,l,k,m])*(state[l]+state[m]) #--
-                                C[i,j,k,q] +=  -0.25*A[i,l,k,m]*(B[m,q,l,j]+B[l,q,m,j])*(state[l]+state[m]) #--
-
-                                if state[l] != state[m]:
-                                    C[i,j,k,q] += -0.25*A[k,j,l,m]*(B[m,l,i,q]+B[i,q,m,l]-B[m,q,i,l]+B[i,l,m,q])*(state[l]-state[m]) #+
-                                    C[i,j,k,q] += -0.25*A[l,m,k,j]*(B[m,l,i,q]+B[i,q,m,l]-B[m,q,i,l]+B[i,l,m,q])*(state[l]-state[m]) #+
-                                    C[i,j,k,q] += 0.25*A[l,j,k,m]*(B[m,l,i,q]+B[i,l,m,q]-B[m,q,i,l]+B[i,q,m,l])*(state[l]-state[m]) #-
-                                    C[i,j,k,q] += 0.25*A[k,l,m,j]*(B[i,m,l,q]+B[i,q,l,m]+B[l,m,i,q]-B[l,q,i,m])*(state[l]-state[m]) #-
-                                C[i,j,k,q] +=  -0.25*A[l,j,m,q]*(B[k,m,i,l]+B[k,l,i,m])*(state[l]+state[m]) #--
-                                C[i,j,k,q] +=  -0.25*A[k,l,i,m]*(B[m,j,l,q]+B[l,j,m,q])*(state[l]+state[m]) #--
+                    acc = 0.
+                    # Indices to be summed over
+                    for l in range(m0):
+                        for m in range(m0):
+                            acc += Wd[l,m]*(A[i,j,l,m]+A[l,m,i,j]-A[l,j,i,m]+A[i,m,l,j])*P[k,q,l,m]
+                            acc += Ws[l,m]*(A[l,j,m,q]*Q[i,k,l,m]+A[i,l,k,m]*R[j,q,l,m])
+                    C[i,j,k,q] = acc
 
-                                if state[l] != state[m]:
-                                    C[i,j,k,q] += 0.25*A[k,q,l,m]*(B[m,l,i,j]+B[i,j,m,l]-B[m,j,i,l]+B[i,l,m,j])*(state[l]-state[m]) #+
-                                    C[i,j,k,q] += 0.25*A[l,m,k,q]*(B[m,l,i,j]+B[i,j,m,l]-B[m,j,i,l]+B[i,l,m,j])*(state[l]-state[m]) #+
-                                    C[i,j,k,q] += -0.25*A[l,q,k,m]*(B[m,l,i,j]+B[i,l,m,j]-B[m,j,i,l]+B[i,j,m,l])*(state[l]-state[m]) #-
-                                    C[i,j,k,q] += -0.25*A[k,l,m,q]*(B[i,m,l,j]+B[i,j,l,m]+B[l,m,i,j]-B[l,j,i,m])*(state[l]-state[m]) #-
-                                C[i,j,k,q] +=  0.25*A[l,q,m,j]*(B[k,m,i,l]+B[k,l,i,m])*(state[l]+state[m]) #--
-                                C[i,j,k,q] +=  0.25*A[k,l,i,m]*(B[m,q,l,j]+B[l,q,m,j])*(state[l]+state[m]) #--
+    # Each set of four elements is handled once, by the thread owning its smallest first index
+    for i in prange(m0):
+        for k in range(i,m0):
+            for j in range(m0):
+                for q in range(j,m0):
+                    if i == k or j == q:
+                        C[i,j,k,q] = 0.
+                        C[i,q,k,j] = 0.
+                        C[k,j,i,q] = 0.
+                        C[k,q,i,j] = 0.
+                    else:
+                        c = C[i,j,k,q] - C[i,q,k,j] - C[k,j,i,q] + C[k,q,i,j]
+                        C[i,j,k,q] = c
+                        C[i,q,k,j] = -c
+                        C[k,j,i,q] = -c
+                        C[k,q,i,j] = c
 
     return C
 
+@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:,:,:],float64[:],float64[:,:,:,:]),nopython=True,fastmath=True,cache=True)
+def con_jit44_NO(A,B,state,C):
+    """ Normal-ordering corrections for two rank-4 tensors.
+
+        The combinations of B are computed once by con_jit44_NO_combine and passed to 
+        con_jit44_NO_loop. The result is written into C. Besides C, this needs three (m,m,m,m) 
+        double-precision temporaries for the combinations of B.
+
+    """
+    P = np.empty(B.shape,dtype=np.float64)
+    Q = np.empty(B.shape,dtype=np.float64)
+    R = np.empty(B.shape,dtype=np.float64)
+    con_jit44_NO_combine(B,P,Q,R)
+    return con_jit44_NO_loop(A,P,Q,R,state,C)
+
+@jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:,:,:],float64[:],float64[:,:,:,:]),nopython=True,fastmath=True,cache=True)
+def con_jit44_NO_fp32(A,B,state,C):
+    """ Mixed-precision version of con_jit44_NO.
+
+        The combinations of B are written directly in single precision, halving their memory footprint
+        and the memory traffic of the inner loop, while the products and the sum are accumulated in 
+        double precision.
+
+    """
+    P = np.empty(B.shape,dtype=np.float32)
+    Q = np.empty(B.shape,dtype=np.float32)
+    R = np.empty(B.shape,dtype=np.float32)
+    con_jit44_NO_combine(B,P,Q,R)
+    return con_jit44_NO_loop(A,P,Q,R,state,C)
+
 @jit(float64[:,:,:,:](float64[:,:,:,:],float64[:,:,:,:],float64[:]),nopython=True,parallel=True,fastmath=True,cache=True)
 def con_jit44_NO_up_mixed(A,B,state):
     C = np.zeros(A.shape,dtype=np.float64)
@@ -26,20 +26,15 @@ This file contains all of the matrix/tensor contraction routines used to compute
 
 """
 
-import os
-from psutil import cpu_count
-# Set up threading options for parallel solver
-os.environ['OMP_NUM_THREADS']= str(int(cpu_count(logical=False))) # Set number of OpenMP threads
-os.environ['MKL_NUM_THREADS']= str(int(cpu_count(logical=False))) # Set number of MKL threads
-os.environ['NUMBA_NUM_THREADS'] = str(int(cpu_count(logical=False))) # Set number of Numba threads
 import numpy as np
-from numba import guvectorize,float64,complex128
+from numba import guvectorize,njit,prange,float64
 # from numba import get_num_threads,threading_layer
          
 #------------------------------------------------------------------------------
 # guvectorize functions
-# Note the different functions for different combinations of Re/Im inputs
-# needed because of the explicit type declarations, not needed for jit
+# The complex contractions are plain njit functions rather than gufuncs: Numba compiles
+# a specialisation for each combination of Re/Im inputs on first use, so a single function
+# covers all of them, and the output array C is allocated once by the caller.
 
 @guvectorize([(float64[:,:],float64[:,:],float64[:,:])],'(n,n),(n,n)->(n,n)',target='cpu',nopython=True)
 def con_vec(A,B,C):
@@ -61,27 +56,11 @@ def con_vec_anti(A,B,C):
                 C[i,j] += A[i,k]*B[k,j] - B[i,k]*A[k,j]
             C[j,i] = -C[i,j]
 
-@guvectorize([(float64[:,:],complex128[:,:],complex128[:,:])],'(n,n),(n,n)->(n,n)',target='cpu',nopython=True)
+@njit(parallel=True,cache=True)
 def con_vec_comp(A,B,C):
+    """ Contract two square matrices, either or both of which may be complex, into C. """
     m,_=A.shape
-    for i in range(m):
-        for j in range(m):
-            for k in range(m):
-                C[i,j] += A[i,k]*B[k,j] - B[i,k]*A[k,j]
-
-@guvectorize([(complex128[:,:],complex128[:,:],complex128[:,:])],'(n,n),(n,n)->(n,n)',target='cpu',nopython=True)
-def con_vec_comp2(A,B,C):
-    m,_=A.shape
-    for i in range(m):
-        for j in range(m):
-            C[i,j] = 0.
-            for k in range(m):
-                C[i,j] += A[i,k]*B[k,j] - B[i,k]*A[k,j]
-    
-@guvectorize([(float64[:,:],complex128[:,:],complex128[:,:])],'(n,n),(n,n)->(n,n)',target='cpu',nopython=True)
-def con_vec_comp3(A,B,C):
-    m,_=A.shape
-    for i in range(m):
+    for i in prange(m):
         for j in range(m):
             C[i,j] = 0.
             for k in range(m):
@@ -141,38 +120,11 @@ def con_vec42_anti(A,B,C):
 
 
 
-@guvectorize([(float64[:,:,:,:],complex128[:,:],complex128[:,:,:,:])],'(n,n,n,n),(n,n)->(n,n,n,n)',target='cpu',nopython=True)
+@njit(parallel=True,cache=True)
 def con_vec42_comp(A,B,C):
+    """ Contract a rank-4 tensor with a square matrix, either or both of which may be complex, into C. """
     m,_,_,_=A.shape
-    for i in range(m):
-        for j in range(m):
-            for k in range(m):
-                for q in range(m):
-                    C[i,j,k,q] = 0.
-                    for l in range(m):
-                        C[i,j,k,q] += A[i,j,k,l]*B[l,q] 
-                        C[i,j,k,q] += -A[i,j,l,q]*B[k,l]
-                        C[i,j,k,q] += A[i,l,k,q]*B[l,j]
-                        C[i,j,k,q] += -A[l,j,k,q]*B[i,l] 
- 
-@guvectorize([(complex128[:,:,:,:],float64[:,:],complex128[:,:,:,:])],'(n,n,n,n),(n,n)->(n,n,n,n)',target='cpu',nopython=True)
-def con_vec42_comp2(A,B,C):
-    m,_,_,_=A.shape
-    for i in range(m):
-        for j in range(m):
-            for k in range(m):
-                for q in range(m):
-                    C[i,j,k,q] = 0.
-                    for l in range(m):
-                        C[i,j,k,q] += A[i,j,k,l]*B[l,q] 
-                        C[i,j,k,q] += -A[i,j,l,q]*B[k,l]
-                        C[i,j,k,q] += A[i,l,k,q]*B[l,j]
-                        C[i,j,k,q] += -A[l,j,k,q]*B[i,l] 
-
-@guvectorize([(complex128[:,:,:,:],complex128[:,:],complex128[:,:,:,:])],'(n,n,n,n),(n,n)->(n,n,n,n)',target='cpu',nopython=True)
-def con_vec42_comp3(A,B,C):
-    m,_,_,_=A.shape
-    for i in range(m):
+    for i in prange(m):
         for j in range(m):
             for k in range(m):
                 for q in range(m):
@@ -36,7 +36,7 @@ os.environ['NUMBA_NUM_THREADS'] = str(int(cpu_count(logical=False)))    # Set nu
 import numpy as np
 from numba import jit
 import gc
-from ..contract import contract,contractNO
+from ..contract import contract,contract_batch,contractNO
 from ..utility import unpack_spin_hamiltonian, eta_spin, indices
 from scipy.integrate import ode
 
@@ -136,8 +136,7 @@ def int_ode_spin(l,y,n,method='jit',norm=True,no_state='CDW'):
         H4updn = ham["H4updn"]
 
         # Then compute the RHS of the flow equations
-        sol_up = contract(eta0up,H2up,method=method)
-        sol_down = contract(eta0down,H2dn,method=method)
+        sol_up,sol_down = contract_batch([eta0up,eta0down],[H2up,H2dn],method=method)
         sol_int_up = contract(eta_int_up,H2up,method=method) + contract(eta0up,H4up,method=method)
         sol_int_down = contract(eta_int_down,H2dn,method=method) + contract(eta0down,H4dn,method=method)
         sol_int_updown = contract(eta_int_updown,H2dn,method=method,pair='second') + contract(eta0down,H4updn,method=method,pair='second')
@@ -28,7 +28,7 @@ This file contains various helper functions.
 
 import os, functools
 import numpy as np
-from .contract import contract,contractNO 
+from .contract import contract,contract_batch,contractNO 
 
 def namevar(dis_type,dsymm,no_state,dyn,norm,n,LIOM,species):
     if norm == True:
@@ -210,8 +210,7 @@ def eta_spin(y,state='CDW',norm=False,method='vec',no_state='CDW'):
     upstate,downstate = states_spin(y["H2up"],y["H2dn"],state=no_state)
 
     # Compute all relevant generators
-    eta2up = contract(H2up_0,V2up,method=method,eta=True)
-    eta2dn = contract(H2dn_0,V2dn,method=method,eta=True)
+    eta2up,eta2dn = contract_batch([H2up_0,H2dn_0],[V2up,V2dn],method=method,eta=True)
     eta4up = contract(H4up_0,V2up,method=method,eta=True) + contract(H2up_0,V4up,method=method,eta=True)
     eta4dn = contract(H4dn_0,V2dn,method=method,eta=True) + contract(H2dn_0,V4dn,method=method,eta=True)
     eta4updn = -contract(V4updn,H2up_0,method=method,eta=True,pair='first') - contract(V4updn,H2dn_0,method=method,eta=True,pair='second')
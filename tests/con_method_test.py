@@ -92,14 +92,14 @@ if __name__ == '__main__':
 
         return error_count
 
-    def test_NO(A,B,method1,method2,eta):
+    def test_NO(A,B,method1,method2,eta,pair=None):
         """ Tests if methods agree to 6 decimal places. """
 
         list1 = np.array([1. for i in range(n//2)])
         list2 = np.array([0. for i in range(n//2)])
         state = np.array([val for pair in zip(list1,list2) for val in pair])
-        a = (con.contractNO(A,B,method=method1,eta=eta,state=state,upstate=state,downstate=state))
-        b = (con.contractNO(A,B,method=method2,eta=eta,state=state,upstate=state,downstate=state))
+        a = (con.contractNO(A,B,method=method1,eta=eta,state=state,upstate=state,downstate=state,pair=pair))
+        b = (con.contractNO(A,B,method=method2,eta=eta,state=state,upstate=state,downstate=state,pair=pair))
 
         a=a.reshape(len(a)**dim(a))
         a=a.astype(np.float32)
@@ -123,6 +123,31 @@ if __name__ == '__main__':
         #     print('SUCCESS: RESULT FROM %s EQUALS %s' %(method1,method2))
 
         return error_count
+
+    def compare(a,b,label,tol=1e-6):
+        """ Tests if two arrays agree to within a tolerance (relative to the largest element of b). """
+
+        a = np.asarray(a)
+        b = np.asarray(b)
+        error = np.max(np.abs(a-b))/max(np.max(np.abs(b)),1.)
+        if error > tol:
+            print('*** WARNING: %s DOES NOT AGREE (max. difference %.3e)' %(label,error))
+
+    def test_out(func,A,B,method,label,**kwargs):
+        """ Tests that writing into C-ordered, Fortran-ordered and strided output buffers returns the buffer 
+            and gives the same result as the unbuffered call. """
+
+        ref = func(A,B,method=method,**kwargs)
+        buffers = {'C-order':np.empty(ref.shape),
+                   'F-order':np.empty(ref.shape,order='F'),
+                   'strided':np.empty(tuple(2*d for d in ref.shape))[tuple(slice(None,None,2) for d in ref.shape)]}
+        for name,buf in buffers.items():
+            # Fill with junk, so that any element which is not written is detected
+            buf[...] = np.random.uniform(-1,1,ref.shape)
+            res = func(A,B,method=method,out=buf,**kwargs)
+            if res is not buf:
+                print('*** WARNING: %s (%s, %s buffer) DOES NOT RETURN THE BUFFER' %(label,method,name))
+            compare(buf,ref,'%s (%s, %s buffer)' %(label,method,name))
             
     # #-----------------------------------------------------------------
     # Generate SYMMETRIC matrices/tensors
@@ -134,7 +159,7 @@ if __name__ == '__main__':
     A4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
     B4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
 
-    methods = ['einsum','tensordot','jit','vec']
+    methods = ['einsum','tensordot','blas','jit','vec']
     loop = [list(zip(permutation, methods)) for permutation in permutations(methods, len(methods))]
 
     for i in range(len(loop)):
@@ -159,7 +184,7 @@ if __name__ == '__main__':
     A4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
     B4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
 
-    methods = ['einsum','tensordot','jit','vec']
+    methods = ['einsum','tensordot','blas','jit','vec']
     loop = [list(zip(permutation, methods)) for permutation in permutations(methods, len(methods))]
 
     for i in range(len(loop)):
@@ -184,7 +209,7 @@ if __name__ == '__main__':
     A4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
     B4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
 
-    methods = ['einsum','tensordot','jit','vec']
+    methods = ['einsum','tensordot','blas','jit','vec']
     loop = [list(zip(permutation, methods)) for permutation in permutations(methods, len(methods))]
 
     for i in range(len(loop)):
@@ -214,7 +239,7 @@ if __name__ == '__main__':
     A4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
     B4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
 
-    methods = ['jit','vec']
+    methods = ['einsum','blas','jit','vec']
     loop = [list(zip(permutation, methods)) for permutation in permutations(methods, len(methods))]
 
     for i in range(len(loop)):
@@ -229,6 +254,79 @@ if __name__ == '__main__':
         for m1,m2 in loop[i]:
             test_NO(A4,B4,m1,m2,eta=True)
 
+    # The jit pair kernels only fill part of the result, so the pair variants are checked without them
+    methods = ['einsum','blas','vec']
+    loop = [list(zip(permutation, methods)) for permutation in permutations(methods, len(methods))]
+
+    for pair in ['first','second']:
+        for i in range(len(loop)):
+            for m1,m2 in loop[i]:
+                test_NO(A2,B4,m1,m2,eta=True,pair=pair)
+
+        for i in range(len(loop)):
+            for m1,m2 in loop[i]:
+                test_NO(A4,B2,m1,m2,eta=True,pair=pair)
+
+    #-----------------------------------------------------------------
+    # PAIR-EXCHANGE SYMMETRY of rank-4 tensors (con42 with sym='pair'/'antipair')
+
+    A4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
+    A4s = (A4+A4.transpose(2,3,0,1))/2
+    A4a = (A4-A4.transpose(2,3,0,1))/2
+    B2 = np.random.uniform(-1,1,n**2).reshape(n,n)
+
+    for B in [(B2+B2.T)/2,(B2-B2.T)/2]:
+        compare(con.con42(A4s,B,method='jit',sym='pair'),con.con42(A4s,B,method='einsum'),'con42 jit sym=pair')
+        compare(con.con42(A4a,B,method='jit',sym='antipair'),con.con42(A4a,B,method='einsum'),'con42 jit sym=antipair')
+
+    #-----------------------------------------------------------------
+    # MIXED-PRECISION normal-ordering corrections (con44_NO with precision='mixed')
+
+    list1 = np.array([1. for i in range(n//2)])
+    list2 = np.array([0. for i in range(n//2)])
+    state = np.array([val for pair in zip(list1,list2) for val in pair])
+    A4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
+    B4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
+
+    compare(con.con44_NO(A4,B4,method='jit',state=state),con.con44_NO(A4,B4,method='einsum',state=state),'con44_NO jit/einsum')
+    compare(con.con44_NO(A4,B4,method='jit',state=state,precision='mixed'),con.con44_NO(A4,B4,method='einsum',state=state),
+            'con44_NO jit precision=mixed',tol=1e-5)
+
+    #-----------------------------------------------------------------
+    # BATCHED contractions of independent pairs of matrices (contract_batch)
+
+    A2 = np.random.uniform(-1,1,3*n**2).reshape(3,n,n)
+    A2 = (A2+A2.transpose(0,2,1))/2
+    B2 = np.random.uniform(-1,1,3*n**2).reshape(3,n,n)
+    B2 = (B2+B2.transpose(0,2,1))/2
+
+    for method in ['einsum','tensordot','blas','jit','vec']:
+        batch = con.contract_batch(A2,B2,method=method,eta=True)
+        for i in range(len(A2)):
+            compare(batch[i],con.contract(A2[i],B2[i],method='einsum'),'contract_batch %s' %method)
+
+
+    #-----------------------------------------------------------------
+    # OUTPUT BUFFERS (out=) for contract and contractNO
+
+    list1 = np.array([1. for i in range(n//2)])
+    list2 = np.array([0. for i in range(n//2)])
+    state = np.array([val for pair in zip(list1,list2) for val in pair])
+    A2 = np.random.uniform(-1,1,n**2).reshape(n,n)
+    A2 = (A2+A2.T)/2
+    B2 = np.random.uniform(-1,1,n**2).reshape(n,n)
+    B2 = (B2-B2.T)/2
+    A4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
+    B4 = np.random.uniform(-1,1,n**4).reshape(n,n,n,n)
+
+    for method in ['einsum','tensordot','blas','jit','vec']:
+        test_out(con.contract,A2,B2,method,'contract 2-2',eta=False)
+        test_out(con.contract,A4,B2,method,'contract 4-2')
+        test_out(con.contract,B2,A4,method,'contract 2-4')
+
+    for method in ['einsum','blas','jit','vec']:
+        test_out(con.contractNO,A4,B4,method,'contractNO 4-4',state=state)
+
     gc.collect()
     print('****************')
     print('Time taken for one run:',datetime.now()-startTime)